@@ -1,9 +1,59 @@
+import asyncio
+import re
 import requests
-import hashlib
+import threading
 import time
+from io import BytesIO
+import warnings
+from collections import OrderedDict, deque
 import pyotp
 import xml.etree.ElementTree as ET
-from pyrate_limiter import Rate, Duration, Limiter, InMemoryBucket
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from pyrate_limiter import Rate, Duration
+
+try:
+    # Precomputes the HMAC inner/outer states, roughly twice as fast as OpenSSL's PBKDF2
+    from fastpbkdf2 import pbkdf2_hmac
+except ImportError:
+    # hashlib calls OpenSSL's PKCS5_PBKDF2_HMAC, which already uses the SHA-NI
+    # code path where the CPU has it. cryptography's PBKDF2HMAC ends up in the
+    # same OpenSSL function, so it is not worth an extra dependency.
+    import hashlib
+
+    _fallback_warned = False
+
+    def pbkdf2_hmac(hash_name: str, password: bytes, salt: bytes, iterations: int) -> bytes:
+        """hashlib fallback, warns once on first use that the fast extra is missing"""
+        global _fallback_warned
+        if not _fallback_warned:
+            _fallback_warned = True
+            warnings.warn(
+                "fastpbkdf2 is not installed, falling back to hashlib for the login challenge",
+                ImportWarning,
+                stacklevel=2,
+            )
+        return hashlib.pbkdf2_hmac(hash_name, password, salt, iterations)
+
+# The SessionInfo documents have a fixed layout, so the fields are read without building a tree
+_LOGIN_RE = re.compile(rb"<Challenge>([^<]+)</Challenge>.*?<BlockTime>(\d+)</BlockTime>", re.DOTALL)
+_SID_RE = re.compile(rb"<SID>([0-9a-fA-F]+)</SID>")
+# 2$<iter1>$<salt1>$<iter2>$<salt2>
+_CHALLENGE_RE = re.compile(r"2\$(\d+)\$([0-9a-fA-F]+)\$(\d+)\$([0-9a-fA-F]+)")
+
+
+def _extract_tags(body: bytes, tags: tuple[str, ...]) -> dict[str, str]:
+    """Stream-parse the XML body in one pass, stopping once the first element of every tag was seen"""
+    found = {}
+    for _, element in ET.iterparse(BytesIO(body), events=("end",)):
+        if element.tag in tags and element.tag not in found:
+            found[element.tag] = element.text
+            if len(found) == len(tags):
+                break
+    missing = [tag for tag in tags if found.get(tag) is None]
+    if missing:
+        raise Exception(f"missing {', '.join(missing)} in FRITZ!Box response")
+    return found
 
 
 class LoginState:
@@ -15,6 +65,8 @@ class LoginState:
 
 class FBSMSLib:
     LOGIN_SID_ROUTE = "/login_sid.lua?version=2"
+    HASH1_CACHE_SIZE = 4
+    REQUEST_TIMEOUT = 10  # seconds
 
     rate: list[Rate] = None
     box_url: str = None
@@ -27,24 +79,61 @@ class FBSMSLib:
     def __init__(
         self, url: str, username: str, password: str, totpsecret: str = None, rate: Rate = None
     ):
-        rate = (
-            [rate] if rate else [Rate(10, Duration.HOUR)]
-        )  # Default rate limit: 10 requests per hour
-        self._bucket = InMemoryBucket(rate)
-        self._rate_limiter = Limiter(self._bucket)
+        rate = rate if rate else Rate(10, Duration.HOUR)  # Default rate limit: 10 requests per hour
+        self._rate_window = rate.interval / 1000  # Rate intervals are in milliseconds
+        self._sent_at: deque[float] = deque(maxlen=rate.limit)
+        self._lock = threading.RLock()
         self.box_url = url
+        self._login_url = f"{url}{self.LOGIN_SID_ROUTE}"
+        self._data_url = f"{url}/data.lua"
+        self._mfa_url = f"{url}/twofactor.lua"
         self.username = username
         self.password = password
+        self._password_bytes = password.encode("utf-8")
+        self._hash1_cache: OrderedDict[tuple[bytes, int], bytes] = OrderedDict()
+        self._totp_cache: tuple[int, str] = (-1, "")
         if totpsecret is not None:
             self.totp = pyotp.TOTP(totpsecret)
+        self._session = self._create_session()
+        # Log in right away so wrong credentials fail here. The PBKDF2 result is
+        # needed immediately, so computing it in a background thread gains nothing.
         self.get_current_sid()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the underlying HTTP session and its pooled connections."""
+        self._session.close()
+
+    @staticmethod
+    def _create_session() -> requests.Session:
+        """Create a session that keeps the connection to the FRITZ!Box alive between requests."""
+        session = requests.Session()
+        # Only idempotent requests are retried, POSTs are never sent twice
+        adapter = HTTPAdapter(
+            pool_connections=2,
+            pool_maxsize=10,
+            max_retries=Retry(total=3, backoff_factor=0.3),
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
     def get_current_sid(self) -> str:
         """Get a valid sid, renew if expired"""
-        if self.__sid is None or time.time() > self.__sid_timeout:
-            self.__sid = self._get_sid()
-        self.__sid_timeout = time.time() + 19 * 60  # renew timeout
-        return self.__sid
+        with self._lock:
+            if self.__sid is None or time.time() > self.__sid_timeout:
+                self.__sid = self._get_sid()
+            self.__sid_timeout = time.time() + 19 * 60  # renew timeout
+            return self.__sid
+
+    async def aget_current_sid(self) -> str:
+        """Like get_current_sid, but runs the login in a worker thread to not block the event loop"""
+        return await asyncio.to_thread(self.get_current_sid)
 
     def _get_sid(self) -> str:
         """Get a sid by solving the PBKDF2 challenge-response process."""
@@ -52,6 +141,8 @@ class FBSMSLib:
             state = self.get_login_state()
         except Exception as ex:
             raise Exception("failed to get challenge") from ex
+        # The block time runs from now, so the PBKDF2 computation counts towards it
+        blocked_until = time.monotonic() + state.blocktime
 
         if state.is_pbkdf2:
             challenge_response = self.calculate_pbkdf2_response(state.challenge)
@@ -60,8 +151,9 @@ class FBSMSLib:
                 "FRITZ!Box does not support PBKDF2. Please update your device firmware (v7.24 or later)."
             )
 
-        if state.blocktime > 0:
-            time.sleep(state.blocktime)
+        remaining_blocktime = blocked_until - time.monotonic()
+        if remaining_blocktime > 0:
+            time.sleep(remaining_blocktime)
 
         try:
             sid = self.send_response(challenge_response)
@@ -73,101 +165,132 @@ class FBSMSLib:
 
     def get_login_state(self) -> LoginState:
         """Get login state from FRITZ!Box using login_sid.lua?version=2"""
-        url = self.box_url + self.LOGIN_SID_ROUTE
-        http_response = requests.get(url)
-        xml = ET.fromstring(http_response.content)
-        challenge = xml.find("Challenge").text
-        blocktime = int(xml.find("BlockTime").text)
-        return LoginState(challenge, blocktime)
+        http_response = self._session.get(self._login_url, timeout=self.REQUEST_TIMEOUT)
+        match = _LOGIN_RE.search(http_response.content)
+        if match is not None:
+            return LoginState(match.group(1).decode(), int(match.group(2)))
+        fields = _extract_tags(http_response.content, ("Challenge", "BlockTime"))
+        return LoginState(fields["Challenge"], int(fields["BlockTime"]))
 
     def calculate_pbkdf2_response(self, challenge: str) -> str:
         """Calculate the response for a given challenge via PBKDF2"""
-        challenge_parts = challenge.split("$")
+        # PBKDF2-HMAC-SHA256 is mandated by the FRITZ!Box login_sid.lua version 2 protocol
+        # (AVM technical note "Session-IDs im FRITZ!Box Webinterface"). The box verifies
+        # this exact hash, so other algorithms such as BLAKE2 or Argon2 are not an option.
+        match = _CHALLENGE_RE.fullmatch(challenge)
+        if match is None:
+            raise Exception(f"unexpected PBKDF2 challenge format: {challenge}")
         # Extract all necessary values encoded into the challenge
-        iter1 = int(challenge_parts[1])
-        salt1 = bytes.fromhex(challenge_parts[2])
-        iter2 = int(challenge_parts[3])
-        salt2 = bytes.fromhex(challenge_parts[4])
+        iter1 = int(match[1])
+        salt1 = bytes.fromhex(match[2])
+        iter2 = int(match[3])
+        salt2 = bytes.fromhex(match[4])
         # Hash twice, once with static salt...
-        hash1 = hashlib.pbkdf2_hmac("sha256", self.password.encode(), salt1, iter1)
+        hash1 = self._get_hash1(salt1, iter1)
         # Once with dynamic salt.
-        hash2 = hashlib.pbkdf2_hmac("sha256", hash1, salt2, iter2)
-        return f"{challenge_parts[4]}${hash2.hex()}"
+        hash2 = pbkdf2_hmac("sha256", hash1, salt2, iter2)
+        return f"{match[4]}${hash2.hex()}"
+
+    def _get_hash1(self, salt1: bytes, iter1: int) -> bytes:
+        """Get the static salt hash, reusing it while the FRITZ!Box keeps the same salt"""
+        key = (salt1, iter1)
+        hash1 = self._hash1_cache.get(key)
+        if hash1 is None:
+            hash1 = pbkdf2_hmac("sha256", self._password_bytes, salt1, iter1)
+            self._hash1_cache[key] = hash1
+            if len(self._hash1_cache) > self.HASH1_CACHE_SIZE:
+                self._hash1_cache.popitem(last=False)
+        else:
+            self._hash1_cache.move_to_end(key)
+        return hash1
 
     def send_response(self, challenge_response: str) -> str:
         """Send the response and return the parsed sid. raises an Exception on error"""
         # Build response params
         post_data = {"username": self.username, "response": challenge_response}
-        headers = {"Content-Type": "application/x-www-form-urlencoded"}
-        url = self.box_url + self.LOGIN_SID_ROUTE
-        http_response = requests.post(url, data=post_data, headers=headers)
+        # requests sends a dict body as application/x-www-form-urlencoded
+        http_response = self._session.post(self._login_url, data=post_data, timeout=self.REQUEST_TIMEOUT)
         # Parse SID from resulting XML.
-        xml = ET.fromstring(http_response.text)
-        return xml.find("SID").text
+        match = _SID_RE.search(http_response.content)
+        if match is not None:
+            return match.group(1).decode()
+        return _extract_tags(http_response.content, ("SID",))["SID"]
 
     def get_sms(self) -> list:
-        SMS_GET_URL = f"{self.box_url}/data.lua"
-
-        req_data = {
-            "xhr": 1,
-            "sid": self.get_current_sid(),
-            "lang": "de",
-            "page": "smsList",
-            "xhrId": "all",
-        }
-        try:
-            sms_response = requests.post(SMS_GET_URL, data=req_data)
-        except requests.exceptions.RequestException as e:
-            raise RuntimeError(e)
+        with self._lock:
+            req_data = {
+                "xhr": 1,
+                "sid": self.get_current_sid(),
+                "lang": "de",
+                "page": "smsList",
+                "xhrId": "all",
+            }
+            try:
+                sms_response = self._session.post(self._data_url, data=req_data, timeout=self.REQUEST_TIMEOUT)
+            except requests.exceptions.RequestException as e:
+                raise RuntimeError(e)
         return sms_response.json()["data"]["smsListData"]["messages"]
 
     def safe_post_request(self, url: str, data: dict) -> requests.Response:
         """Helper function to handle POST requests with error handling."""
         try:
-            return requests.post(url, data=data)
+            return self._session.post(url, data=data, timeout=self.REQUEST_TIMEOUT)
         except requests.exceptions.RequestException as e:
             raise RuntimeError(f"Request to {url} failed: {e}")
 
     def enforce_rate_limit(self):
         """Enforce rate limiting for sending SMS."""
-        try:
-            self._rate_limiter.try_acquire("sms_send")
-        except Exception as e:
-            raise RuntimeError(
-                "Rate limit exceeded. Please wait before sending more SMS."
-            ) from e
+        with self._lock:
+            now = time.monotonic()
+            # Sliding window: the oldest of the last `limit` sends must be outside the window
+            if len(self._sent_at) == self._sent_at.maxlen and (
+                not self._sent_at or now - self._sent_at[0] < self._rate_window
+            ):
+                raise RuntimeError("Rate limit exceeded. Please wait before sending more SMS.")
+            self._sent_at.append(now)
+
+    def _totp_now(self) -> str:
+        """Get the current TOTP code, computed once per time step"""
+        step = int(time.time() // self.totp.interval)
+        if self._totp_cache[0] != step:
+            self._totp_cache = (step, self.totp.generate_otp(step))
+        return self._totp_cache[1]
 
     def send_sms(self, receiver: str, message: str):
-        self.enforce_rate_limit()  # Apply rate limiting
+        # One SMS flow at a time per instance, the 2FA steps must not interleave on the box
+        with self._lock:
+            self._send_sms(receiver, message)
 
-        SMS_SEND_URL = f"{self.box_url}/data.lua"
-        MFA_URL = f"{self.box_url}/twofactor.lua"
+    def _send_sms(self, receiver: str, message: str):
+        self.enforce_rate_limit()  # Apply rate limiting
+        sid = self.get_current_sid()  # valid for the whole transaction
 
         req_data = {
             "xhr": 1,
-            "sid": self.get_current_sid(),
+            "sid": sid,
             "lang": "de",
             "recipient": receiver,
             "page": "smsSendMsg",
             "apply": "true",
             "newMessage": message,
         }
-        response1 = self.safe_post_request(SMS_SEND_URL, req_data)
+        response1 = self.safe_post_request(self._data_url, req_data)
+        data1 = response1.json()["data"]
 
-        if response1.json()["data"]["apply"] != "ok":
-            if response1.json()["data"]["apply"] == "valerror":
-                raise RuntimeError(f"Validation error: {response1.json()['data']['valerror']}")
-            raise RuntimeError(f"Failed to initiate SMS sending. Response: {response1.json()['data']}")
+        if data1["apply"] != "ok":
+            if data1["apply"] == "valerror":
+                raise RuntimeError(f"Validation error: {data1['valerror']}")
+            raise RuntimeError(f"Failed to initiate SMS sending. Response: {data1}")
 
         # Everything done, no 2FA needed
-        if "redirect" in response1.json()["data"].keys():
+        if "redirect" in data1:
             return
 
-        uid = response1.json()["data"]["new_uid"]
+        uid = data1["new_uid"]
 
         req_data = {
             "xhr": 1,
-            "sid": self.get_current_sid(),
+            "sid": sid,
             "lang": "de",
             "receipient": receiver,
             "page": "smsSendMsg",
@@ -175,33 +298,36 @@ class FBSMSLib:
             "new_uid": uid,
             "newMessage": message,
         }
-        response2 = self.safe_post_request(SMS_SEND_URL, req_data)
+        response2 = self.safe_post_request(self._data_url, req_data)
+        data2 = response2.json()["data"]
 
-        if response2.json()["data"]["second_apply"] == "twofactor":
-            if "googleauth" in response2.json()["data"]["twofactor"]:
+        if data2["second_apply"] == "twofactor":
+            if "googleauth" in data2["twofactor"]:
                 if self.totp is None:
                     raise RuntimeError("2FA required but no TOTP secret provided during initialization.")
 
+                # Each 2FA step depends on the box state left by the previous one, so they
+                # stay sequential; they share the session's keep-alive connection.
                 # we need tfa_googleauth_info
                 req_data = {
                     "xhr": 1,
-                    "sid": self.get_current_sid(),
+                    "sid": sid,
                     "tfa_googleauth_info": "",
                     "no_sidrenew": "",
                 }
-                self.safe_post_request(MFA_URL, req_data)
+                self.safe_post_request(self._mfa_url, req_data)
 
                 req_data = {
                     "xhr": 1,
-                    "sid": self.get_current_sid(),
-                    "tfa_googleauth": self.totp.now(),
+                    "sid": sid,
+                    "tfa_googleauth": self._totp_now(),
                     "no_sidrenew": "",
                 }
-                self.safe_post_request(MFA_URL, req_data)
+                self.safe_post_request(self._mfa_url, req_data)
 
                 req_data = {
                     "xhr": 1,
-                    "sid": self.get_current_sid(),
+                    "sid": sid,
                     "lang": "de",
                     "receipient": receiver,
                     "page": "smsSendMsg",
@@ -211,22 +337,29 @@ class FBSMSLib:
                     "confirmed": "",
                     "twofactor": "",
                 }
-                self.safe_post_request(SMS_SEND_URL, req_data)
+                self.safe_post_request(self._data_url, req_data)
             else:
                 raise NotImplementedError(
-                    f"Two-factor authentication method not implemented: {response2.json()['data']['twofactor']}"
+                    f"Two-factor authentication method not implemented: {data2['twofactor']}"
                 )
         else:
             raise NotImplementedError(
-                f"second_apply is not two_factor: {response2.json()['data']['second_apply']}"
+                f"second_apply is not two_factor: {data2['second_apply']}"
             )
 
         # return sms_response.json()['data']['smsListData']['messages']
 
+    async def asend_sms(self, receiver: str, message: str):
+        """Like send_sms, but runs in a worker thread to not block the event loop"""
+        await asyncio.to_thread(self.send_sms, receiver, message)
+
     def send_sms_multiple(self, receiver: list[str], message: str):
         for id, r in enumerate(receiver):
             if id > 0:
-                time.sleep(5)
+                # Renew an expired sid during the pause rather than after it
+                resume_at = time.monotonic() + 5
+                self.get_current_sid()
+                time.sleep(max(0.0, resume_at - time.monotonic()))
             self.send_sms(r, message)
 
     def get_sms_incoming(self) -> list: